@@ -1,13 +1,34 @@
 import asyncio
-import json
-from typing import Optional, Dict, Any, Annotated
+import copy
+import hashlib
+import logging
+import os
+import re
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import AsyncExitStack
+from functools import lru_cache
+from typing import Optional, Dict, Any, Annotated, List, Awaitable, Literal, Tuple, Type
 
-import requests
+import aiohttp
+import msgspec
+import orjson
+import simdjson
 from pydantic import Field
+from huggingface_hub import hf_hub_download
+from tokenizers import Tokenizer
 
 from agent_framework import ChatAgent, ai_function
 from agent_framework.azure import AzureAIAgentClient
-from azure.identity.aio import AzureCliCredential
+from azure.identity.aio import (
+    AzureCliCredential,
+    ChainedTokenCredential,
+    DefaultAzureCredential,
+)
+
+
+logger = logging.getLogger(__name__)
 
 
 # ========= Cloud Symptom Checker Instructions =========
@@ -29,7 +50,13 @@ General behavior:
 Tool usage:
 - When the user provides raw lab report text, or mentions “labs below” or “see labs”, 
   you MUST call the `summarize_lab_report` tool to convert the labs into structured data
-  before giving your triage guidance.
+  before giving your triage guidance. If there are several separate lab reports, call
+  `summarize_lab_reports` once with all of them instead.
+- If you can do other work while the labs are processed, call `start_lab_report_summary`
+  instead; it returns a task_id right away. Fetch the summary later with
+  `get_tool_result(task_id)`, which reports "IN_PROGRESS" until it is ready.
+- If the message already contains a "Pre-computed structured labs" section, use it
+  as the tool result and do NOT call `summarize_lab_report` again for those labs.
 - Use the tool result as context, but do NOT expose the raw JSON directly. 
   Instead, summarize the key abnormal findings in plain language.
 """.strip()
@@ -40,8 +67,47 @@ Tool usage:
 FOUNDRY_LOCAL_BASE = "http://127.0.0.1:52403"      # from `foundry service status`
 FOUNDRY_LOCAL_CHAT_URL = FOUNDRY_LOCAL_BASE + "/v1/chat/completions"
 
-# This is the model id you confirmed works:
-FOUNDRY_LOCAL_MODEL_ID = "Phi-4-mini-instruct-cuda-gpu:5"
+# This is the model id you confirmed works. Set FOUNDRY_MODEL to swap in another
+# variant (e.g. a different quantization from `foundry model list`) without code edits.
+FOUNDRY_LOCAL_MODEL_ID = os.getenv("FOUNDRY_MODEL", "Phi-4-mini-instruct-cuda-gpu:5")
+
+# Context window the local model is served with; prompt plus output must fit.
+LOCAL_LAB_CONTEXT_TOKENS = 4096
+
+# Shared HTTP session for Foundry Local calls (created lazily, closed in main).
+# Keep-alive connections to the loopback endpoint are reused across tool calls.
+FOUNDRY_LOCAL_MAX_CONNECTIONS = 4
+_SESSION: Optional[aiohttp.ClientSession] = None
+
+# Foundry Local serializes inference on the GPU anyway; queue local calls here so
+# parallel tool calls from the agent wait without tying up server slots.
+FOUNDRY_LOCAL_MAX_CONCURRENCY = 1
+_LOCAL_MODEL_SLOTS = asyncio.Semaphore(FOUNDRY_LOCAL_MAX_CONCURRENCY)
+
+
+def _get_session() -> aiohttp.ClientSession:
+    """
+    Return the shared aiohttp session, creating it on first use.
+    """
+    global _SESSION
+    if _SESSION is None or _SESSION.closed:
+        _SESSION = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=FOUNDRY_LOCAL_MAX_CONNECTIONS,
+                force_close=False,
+            ),
+        )
+    return _SESSION
+
+
+async def _close_session() -> None:
+    """
+    Close the shared aiohttp session if it was opened.
+    """
+    global _SESSION
+    if _SESSION is not None and not _SESSION.closed:
+        await _SESSION.close()
+    _SESSION = None
 
 
 LOCAL_LAB_SYSTEM_PROMPT = """
@@ -66,22 +132,637 @@ backticks, markdown, or text outside the JSON. The JSON must have this shape:
 If you are unsure about a field, use null. Do NOT invent values.
 """.strip()
 
+# JSON schema for constrained decoding (mirrors the shape in the prompt above).
+# The results array is deliberately unbounded: dropping findings is worse than
+# failing loudly when the output does not fit max_tokens.
+LAB_SUMMARY_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "overall_assessment": {"type": "string"},
+        "notable_abnormal_results": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "test": {"type": "string"},
+                    "value": {"type": "string"},
+                    "unit": {"type": ["string", "null"]},
+                    "reference_range": {"type": ["string", "null"]},
+                    "severity": {"enum": ["mild", "moderate", "severe"]},
+                },
+                "required": ["test", "value", "unit", "reference_range", "severity"],
+                "additionalProperties": False,
+            },
+        },
+    },
+    "required": ["overall_assessment", "notable_abnormal_results"],
+    "additionalProperties": False,
+}
+
+
+# Typed mirror of the schema; model output is decoded and validated into these
+class AbnormalResult(msgspec.Struct):
+    test: str
+    value: str
+    severity: Literal["mild", "moderate", "severe"]
+    unit: Optional[str] = None
+    reference_range: Optional[str] = None
+
+
+class LabSummary(msgspec.Struct):
+    overall_assessment: str
+    notable_abnormal_results: List[AbnormalResult]
+
+
+class LabSummaryBatch(msgspec.Struct):
+    reports: List[LabSummary]
+
+
+# Output size, measured on the demo report: one result such as the CRP row is
+# ~120 chars compact / ~190 chars indented, i.e. ~35-50 tokens; the envelope plus
+# a one-sentence assessment is ~80-100 tokens.
+LAB_SUMMARY_BASE_TOKENS = 96
+LAB_RESULT_TOKENS = 48
+
+# Output may use up to half the context window (~40 full-size results); the
+# other half is left for the system prompt and the report. The floor is the
+# original fixed budget.
+LOCAL_LAB_MAX_TOKENS = LOCAL_LAB_CONTEXT_TOKENS // 2
+LOCAL_LAB_MIN_TOKENS = 256
+
+# Stop right after the JSON object instead of decoding trailing whitespace
+LOCAL_LAB_STOP = ["\n\n"]
+
+_ABNORMAL_FLAG_RE = re.compile(r"\b(?:HIGH|LOW)\b")
+
+
+def _count_flags(lab_text: str) -> int:
+    return len(_ABNORMAL_FLAG_RE.findall(lab_text))
+
+
+def _output_tokens_for(n_flagged: int) -> int:
+    """
+    Tokens a full summary needs: envelope plus one result per flagged row.
+    """
+    return LAB_SUMMARY_BASE_TOKENS + LAB_RESULT_TOKENS * max(1, n_flagged)
+
+
+def _estimate_max_tokens(lab_text: str) -> int:
+    """
+    Size the decode budget from the number of flagged results.
+
+    Never below the original fixed budget: unused max_tokens cost nothing since
+    the stream is cut at the closing brace, while a short budget truncates JSON.
+    The only upper bound is the context-derived LOCAL_LAB_MAX_TOKENS; larger
+    reports are split before they get here.
+    """
+    needed = _output_tokens_for(_count_flags(lab_text))
+    return max(LOCAL_LAB_MIN_TOKENS, min(LOCAL_LAB_MAX_TOKENS, needed))
+
+
+# Batched variant: several reports summarized in one local inference
+LOCAL_LAB_BATCH_SYSTEM_PROMPT = """
+You are a medical lab report summarizer running locally on the user's machine.
+
+You will receive several lab reports, each introduced by a line like
+"=== REPORT 1 ===". Summarize each report independently.
+
+You MUST respond with ONLY one valid JSON object. Do not include any explanation,
+backticks, markdown, or text outside the JSON. The JSON must have this shape,
+with exactly one entry in "reports" per input report, in the same order:
+
+{
+  "reports": [
+    {
+      "overall_assessment": "<short plain English summary>",
+      "notable_abnormal_results": [
+        {
+          "test": "string",
+          "value": "string",
+          "unit": "string or null",
+          "reference_range": "string or null",
+          "severity": "mild|moderate|severe"
+        }
+      ]
+    }
+  ]
+}
+
+If you are unsure about a field, use null. Do NOT invent values.
+""".strip()
+
+
+def _lab_batch_schema(n_reports: int) -> Dict[str, Any]:
+    """
+    JSON schema for a batch response holding exactly `n_reports` summaries.
+    """
+    return {
+        "type": "object",
+        "properties": {
+            "reports": {
+                "type": "array",
+                "minItems": n_reports,
+                "maxItems": n_reports,
+                "items": LAB_SUMMARY_SCHEMA,
+            },
+        },
+        "required": ["reports"],
+        "additionalProperties": False,
+    }
+
+
+# Byte -> "is whitespace" lookup table. Only ASCII entries can be set, since bytes
+# >= 0x80 are parts of UTF-8 sequences rather than characters.
+_WS_MASK = bytes(1 if chr(i).isspace() else 0 for i in range(128)) + bytes(128)
+
 
 def _strip_code_fences(text: str) -> str:
     """
     Remove ```json ... ``` or ``` ... ``` fences if present.
+
+    The trailing fence may be missing when the stream was cut at the closing brace.
+    """
+    # Fast path: no fence anywhere, skip the scan
+    if "```" not in text:
+        return text.strip()
+
+    b = text.encode()
+    start, end = 0, len(b)
+    while start < end and _WS_MASK[b[start]]:
+        start += 1
+    if b[start:start + 3] != b"```":
+        return text.strip()
+    start += 3
+    while start < end and _WS_MASK[b[start]]:
+        start += 1
+    # optional language tag like "json"
+    if b[start:start + 4].lower() == b"json":
+        start += 4
+    while start < end and _WS_MASK[b[start]]:
+        start += 1
+
+    while end > start and _WS_MASK[b[end - 1]]:
+        end -= 1
+    if b[end - 3:end] == b"```" and end - 3 >= start:
+        end -= 3
+        while end > start and _WS_MASK[b[end - 1]]:
+            end -= 1
+    return b[start:end].decode()
+
+
+# ASCII layout in lab reports (separator rules, dot leaders, column padding)
+# costs prompt tokens without carrying any medical content.
+_SEPARATOR_RE = re.compile(r"-{5,}")
+_DOT_LEADER_RE = re.compile(r"\.{3,}")
+_SPACE_RUN_RE = re.compile(r"[ \t]{2,}")
+_LINE_PAD_RE = re.compile(r"[ \t]*\n[ \t]*")
+_BLANK_RUN_RE = re.compile(r"\n{3,}")
+
+
+def _normalize_lab_text(text: str) -> str:
+    """
+    Collapse formatting whitespace/separators so the local model sees fewer tokens.
+    """
+    text = _SEPARATOR_RE.sub("", text)
+    text = _DOT_LEADER_RE.sub(" ", text)
+    text = _SPACE_RUN_RE.sub(" ", text)
+    text = _LINE_PAD_RE.sub("\n", text)
+    text = _BLANK_RUN_RE.sub("\n\n", text)
+    return text.strip()
+
+
+def _content_text(content: Any) -> str:
+    """
+    Flatten OpenAI-style message content (string or list-of-parts) to text.
+    """
+    if isinstance(content, list):
+        return "".join(
+            part.get("text", "") for part in content if isinstance(part, dict)
+        )
+    return content or ""
+
+
+class _OuterObjectScanner:
+    """
+    Track brace depth across streamed text to detect when the outer JSON
+    object is complete (string literals and escapes are respected).
+    """
+
+    def __init__(self) -> None:
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, text: str) -> int:
+        """
+        Return the index just past the outer closing brace in `text`, or -1.
+        """
+        for i, ch in enumerate(text):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif ch == "\\":
+                    self.escaped = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = self.depth > 0
+            elif ch == "{":
+                self.depth += 1
+            elif ch == "}" and self.depth > 0:
+                self.depth -= 1
+                if self.depth == 0:
+                    return i + 1
+        return -1
+
+
+# Lazy parser for the OpenAI-style chunk envelope: only the delta content is
+# materialized, the rest of the tree (ids, usage, ...) is never converted.
+_ENVELOPE_PARSER = simdjson.Parser()
+_DELTA_CONTENT_POINTER = "/choices/0/delta/content"
+
+
+def _delta_content(data: bytes) -> str:
+    """
+    Extract choices[0].delta.content from one streamed chunk.
+    """
+    try:
+        content = _ENVELOPE_PARSER.parse(data).at_pointer(_DELTA_CONTENT_POINTER)
+    except (KeyError, IndexError):
+        return ""
+    if isinstance(content, simdjson.Array):
+        content = content.as_list()
+    return _content_text(content)
+
+
+# SSE events read past the closing brace while waiting for `[DONE]`. Draining a
+# finished stream keeps its keep-alive connection in the pool; if the model is
+# still generating after this many events, the connection is dropped instead.
+_STREAM_DRAIN_EVENTS = 8
+
+
+async def _stream_chat_completion(body: bytes) -> str:
+    """
+    POST a streaming chat completion to Foundry Local and return the content.
+
+    SSE `data:` chunks are consumed as they arrive; content collection stops as
+    soon as the outer JSON object in the model output is closed. `body` must be a
+    serialized request with `"stream": true`.
+    """
+    parts = []
+    scanner = _OuterObjectScanner()
+    drained = -1
+
+    logger.debug("[LOCAL TOOL] POST %s", FOUNDRY_LOCAL_CHAT_URL)
+    # Non-blocking POST so the agent loop keeps running during local inference
+    async with _LOCAL_MODEL_SLOTS, _get_session().post(
+        FOUNDRY_LOCAL_CHAT_URL,
+        headers=_HEADERS,
+        data=body,
+        timeout=aiohttp.ClientTimeout(total=120),
+    ) as resp:
+        resp.raise_for_status()
+        async for raw_line in resp.content:
+            line = raw_line.strip()
+            if not line.startswith(b"data:"):
+                continue
+            data = line[5:].strip()
+            if data == b"[DONE]":
+                break
+
+            # Object already closed: only drain the tail of the stream
+            if drained >= 0:
+                drained += 1
+                if drained > _STREAM_DRAIN_EVENTS:
+                    break
+                continue
+
+            # OpenAI-compatible stream shape: choices[0].delta.content
+            delta = _delta_content(data)
+            if not delta:
+                continue
+
+            end = scanner.feed(delta)
+            if end >= 0:
+                parts.append(delta[:end])
+                drained = 0
+                continue
+            parts.append(delta)
+
+    if drained < 0 and scanner.depth > 0:
+        raise ValueError(
+            "Local model output hit max_tokens before the JSON object was complete"
+        )
+    return "".join(parts)
+
+
+# Small LRU of parsed summaries keyed by a hash of the normalized lab text,
+# so re-sent reports skip another local inference.
+SUMMARY_CACHE_SIZE = 32
+_SUMMARY_CACHE: "OrderedDict[bytes, Dict[str, Any]]" = OrderedDict()
+
+
+def _summary_cache_key(lab_text: str) -> bytes:
+    return hashlib.blake2b(lab_text.strip().encode(), digest_size=16).digest()
+
+
+def _summary_cache_get(key: bytes) -> Optional[Dict[str, Any]]:
+    cached = _SUMMARY_CACHE.get(key)
+    if cached is None:
+        return None
+    _SUMMARY_CACHE.move_to_end(key)
+    # Hand out a copy so callers can't mutate the cached entry
+    return copy.deepcopy(cached)
+
+
+def _summary_cache_put(key: bytes, lab_summary: Dict[str, Any]) -> None:
+    _SUMMARY_CACHE[key] = copy.deepcopy(lab_summary)
+    _SUMMARY_CACHE.move_to_end(key)
+    while len(_SUMMARY_CACHE) > SUMMARY_CACHE_SIZE:
+        _SUMMARY_CACHE.popitem(last=False)
+
+
+# Request pieces that never change between calls are built once at import.
+_HEADERS = {"Content-Type": "application/json"}
+
+_BASE_PAYLOAD = {
+    "model": FOUNDRY_LOCAL_MODEL_ID,
+    "stream": True,
+    "stop": LOCAL_LAB_STOP,
+    "temperature": 0.2,
+}
+
+
+def _request_prefix(system_prompt: str, schema_name: str, schema: Dict[str, Any]) -> bytes:
+    """
+    Pre-serialize a request body up to the user message content.
+
+    The result ends with `..."messages":[{system},{"role":"user","content":` and
+    is completed by `_request_body`.
+    """
+    head = orjson.dumps({
+        **_BASE_PAYLOAD,
+        "response_format": {
+            "type": "json_schema",
+            "json_schema": {
+                "name": schema_name,
+                "schema": schema,
+                "strict": True,
+            },
+        },
+        "messages": [{"role": "system", "content": system_prompt}],
+    })
+    # Drop the closing `]}` and open the user message
+    return head[:-2] + b',{"role":"user","content":'
+
+
+def _request_body(prefix: bytes, user_content: str, max_tokens: int) -> bytes:
+    """
+    Splice the user content and decode budget onto a pre-serialized prefix.
+    """
+    return b"".join((
+        prefix,
+        orjson.dumps(user_content),
+        b'}],"max_tokens":',
+        str(max_tokens).encode(),
+        b"}",
+    ))
+
+
+_LAB_REQUEST_PREFIX = _request_prefix(
+    LOCAL_LAB_SYSTEM_PROMPT, "lab_summary", LAB_SUMMARY_SCHEMA
+)
+
+
+@lru_cache(maxsize=8)
+def _lab_batch_request_prefix(n_reports: int) -> bytes:
+    return _request_prefix(
+        LOCAL_LAB_BATCH_SYSTEM_PROMPT, "lab_summary_batch", _lab_batch_schema(n_reports)
+    )
+
+
+async def _run_lab_model(
+    body: bytes,
+    summary_type: Type[msgspec.Struct],
+) -> Dict[str, Any]:
+    """
+    Run a local completion, then decode and validate the model's JSON as `summary_type`.
+
+    Returns the validated result as plain builtins (dict/list/str) for the agent.
+    """
+    content_text = await _stream_chat_completion(body)
+
+    logger.debug("[LOCAL TOOL] Raw content from model:\n%s", content_text)
+
+    # Constrained decoding should yield bare JSON; fall back to fence stripping
+    try:
+        parsed = msgspec.json.decode(content_text, type=summary_type)
+    except msgspec.DecodeError:
+        parsed = msgspec.json.decode(_strip_code_fences(content_text), type=summary_type)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "[LOCAL TOOL] Parsed lab summary JSON:\n%s",
+            msgspec.json.format(msgspec.json.encode(parsed)).decode(),
+        )
+    return msgspec.to_builtins(parsed)
+
+
+# Context preflight: oversized reports are split before they reach the GPU.
+# Each chunk's prompt plus its own output budget must fit the context window.
+LOCAL_LAB_TOKENIZER_ID = "microsoft/Phi-4-mini-instruct"
+# Optional path to a tokenizer.json; otherwise only the local Hugging Face cache
+# is checked (no download). Without a tokenizer, UTF-8 byte counts are used.
+LOCAL_LAB_TOKENIZER_PATH = os.getenv("FOUNDRY_TOKENIZER")
+# Chat template role markers etc. around the two messages
+_CHAT_TEMPLATE_TOKENS = 32
+# Per-piece allowance when packing separately counted pieces into one chunk
+_JOIN_SLACK_TOKENS = 4
+
+# Panel headers are all-caps lines, e.g. "COMPLETE BLOOD COUNT (CBC)"
+_SECTION_HEADER_RE = re.compile(r"^[A-Z][A-Z0-9 ()&/,.-]{3,}$", re.MULTILINE)
+
+
+def _load_tokenizer() -> Optional[Tokenizer]:
+    """
+    Load the local model's tokenizer from disk only; None if it isn't available.
+    """
+    try:
+        path = LOCAL_LAB_TOKENIZER_PATH or hf_hub_download(
+            LOCAL_LAB_TOKENIZER_ID, "tokenizer.json", local_files_only=True
+        )
+        return Tokenizer.from_file(path)
+    except Exception as exc:
+        logger.debug("[LOCAL TOOL] Tokenizer unavailable: %s", exc)
+        return None
+
+
+_TOKENIZER = _load_tokenizer()
+if _TOKENIZER is None:
+    logger.warning(
+        "[LOCAL TOOL] Tokenizer %s not found locally, sizing reports by byte count",
+        LOCAL_LAB_TOKENIZER_ID,
+    )
+
+
+def _tokenizer() -> Optional[Tokenizer]:
+    """
+    Return the tokenizer, retrying the (local, cheap) load if it failed before.
+    """
+    global _TOKENIZER
+    if _TOKENIZER is None:
+        _TOKENIZER = _load_tokenizer()
+    return _TOKENIZER
+
+
+def _count_tokens(text: str, tokenizer: Optional[Tokenizer]) -> int:
+    """
+    Token count of `text`; without a tokenizer, its UTF-8 length (an upper bound
+    for byte-level BPE).
+    """
+    if tokenizer is None:
+        return len(text.encode())
+    return len(tokenizer.encode(text, add_special_tokens=False).ids)
+
+
+def _input_budget(system_prompt: str, max_tokens: int, tokenizer: Optional[Tokenizer]) -> int:
+    """
+    Tokens left for user content once the system prompt and output are reserved.
+    """
+    return (
+        LOCAL_LAB_CONTEXT_TOKENS
+        - _count_tokens(system_prompt, tokenizer)
+        - max_tokens
+        - _CHAT_TEMPLATE_TOKENS
+    )
+
+
+def _fits_single_request(n_tokens: int, n_flagged: int, window: int) -> bool:
+    """
+    Whether a chunk of `n_tokens` with `n_flagged` rows fits prompt and output.
+    """
+    output = max(LOCAL_LAB_MIN_TOKENS, _output_tokens_for(n_flagged))
+    return output <= LOCAL_LAB_MAX_TOKENS and n_tokens + output <= window
+
+
+def _split_in_half(text: str, tokenizer: Optional[Tokenizer]) -> List[str]:
+    """
+    Cut a single oversized line roughly in half (by tokens, or by UTF-8 bytes).
+    """
+    if tokenizer is not None:
+        offsets = tokenizer.encode(text, add_special_tokens=False).offsets
+        if len(offsets) < 2:
+            return [text]
+        cut = offsets[len(offsets) // 2][0]
+    else:
+        data = text.encode()
+        cut_byte = len(data) // 2
+        # Back off to a character boundary
+        while cut_byte > 0 and (data[cut_byte] & 0xC0) == 0x80:
+            cut_byte -= 1
+        cut = len(data[:cut_byte].decode())
+    if cut <= 0 or cut >= len(text):
+        return [text]
+    return [text[:cut], text[cut:]]
+
+
+def _split_for_context(lab_text: str) -> List[str]:
+    """
+    Split `lab_text` into chunks whose prompt and output budget each fit the window.
+
+    Whole panels are packed together where possible; a panel that is too large
+    on its own is split by lines, and a line that is still too large in halves.
+    Flagged rows count towards the output budget, so dense panels split earlier.
+    """
+    window = LOCAL_LAB_CONTEXT_TOKENS - _CHAT_TEMPLATE_TOKENS
+
+    # Byte length bounds the token count, so typical reports skip the tokenizer
+    n_flagged = _count_flags(lab_text)
+    bytes_window = window - len(LOCAL_LAB_SYSTEM_PROMPT.encode())
+    if _fits_single_request(len(lab_text.encode()), n_flagged, bytes_window):
+        return [lab_text]
+
+    tokenizer = _tokenizer()
+    window -= _count_tokens(LOCAL_LAB_SYSTEM_PROMPT, tokenizer)
+
+    def fits(text: str) -> bool:
+        return _fits_single_request(_count_tokens(text, tokenizer), _count_flags(text), window)
+
+    def split(text: str) -> List[str]:
+        if fits(text):
+            return [text]
+        starts = [0] + [m.start() for m in _SECTION_HEADER_RE.finditer(text) if m.start() > 0]
+        parts = [text[a:b] for a, b in zip(starts, starts[1:] + [len(text)])]
+        if len(parts) == 1:
+            parts = text.splitlines(keepends=True)
+        if len(parts) == 1:
+            parts = _split_in_half(text, tokenizer)
+        if len(parts) == 1:
+            return parts
+        return [piece for part in parts for piece in split(part)]
+
+    chunks, current, current_tokens, current_flags = [], [], 0, 0
+    for piece in split(lab_text):
+        # Counts are summed per piece; joins can re-tokenize into a few extra tokens
+        n, f = _count_tokens(piece, tokenizer) + _JOIN_SLACK_TOKENS, _count_flags(piece)
+        if current and not _fits_single_request(current_tokens + n, current_flags + f, window):
+            chunks.append("".join(current))
+            current, current_tokens, current_flags = [], 0, 0
+        current.append(piece)
+        current_tokens += n
+        current_flags += f
+    if current:
+        chunks.append("".join(current))
+    return [chunk.strip() for chunk in chunks if chunk.strip()]
+
+
+def _merge_summaries(summaries: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Combine per-chunk summaries of one report into a single summary.
+    """
+    return {
+        "overall_assessment": " ".join(
+            s["overall_assessment"] for s in summaries if s["overall_assessment"]
+        ),
+        "notable_abnormal_results": [
+            result for s in summaries for result in s["notable_abnormal_results"]
+        ],
+    }
+
+
+async def _summarize_chunk(lab_text: str) -> Dict[str, Any]:
+    body = _request_body(_LAB_REQUEST_PREFIX, lab_text, _estimate_max_tokens(lab_text))
+    return await _run_lab_model(body, LabSummary)
+
+
+async def summarize_lab_text(lab_text: str) -> Dict[str, Any]:
+    """
+    Summarize a lab report using Foundry Local (Phi-4-mini) on the user's GPU.
+
+    Returns a JSON-compatible dict with:
+    - overall_assessment: short text summary
+    - notable_abnormal_results: list of abnormal test objects
     """
-    stripped = text.strip()
-    if stripped.startswith("```"):
-        # remove leading ```
-        stripped = stripped[3:].lstrip()
-        # optional language tag like "json"
-        if stripped.lower().startswith("json"):
-            stripped = stripped[4:].lstrip()
-        # remove trailing ```
-        if stripped.endswith("```"):
-            stripped = stripped[:-3].rstrip()
-    return stripped
+
+    lab_text = _normalize_lab_text(lab_text)
+
+    cache_key = _summary_cache_key(lab_text)
+    cached = _summary_cache_get(cache_key)
+    if cached is not None:
+        logger.debug("[LOCAL TOOL] Cache hit for lab report")
+        return cached
+
+    chunks = _split_for_context(lab_text)
+    if len(chunks) == 1:
+        lab_summary = await _summarize_chunk(lab_text)
+    else:
+        logger.debug("[LOCAL TOOL] Lab report split into %d chunks", len(chunks))
+        lab_summary = _merge_summaries(
+            await asyncio.gather(*(_summarize_chunk(chunk) for chunk in chunks))
+        )
+
+    _summary_cache_put(cache_key, lab_summary)
+
+    return lab_summary
 
 
 @ai_function(
@@ -91,64 +772,329 @@ def _strip_code_fences(text: str) -> str:
         "running on the user's GPU. Use this whenever the user provides lab results as text."
     ),
 )
-def summarize_lab_report(
+async def summarize_lab_report(
     lab_text: Annotated[str, Field(description="The raw text of the lab report to summarize.")],
 ) -> Dict[str, Any]:
     """
     Tool: summarize a lab report using Foundry Local (Phi-4-mini) on the user's GPU.
+    """
+    # Return dict – Agent Framework will serialize this as the tool result
+    return await summarize_lab_text(lab_text)
 
-    Returns a JSON-compatible dict with:
-    - overall_assessment: short text summary
-    - notable_abnormal_results: list of abnormal test objects
+
+def _batch_fits(user_content: str, max_tokens: int) -> bool:
+    """
+    Whether a batched prompt plus its summed output budget fits the context window.
     """
+    if max_tokens > LOCAL_LAB_MAX_TOKENS:
+        return False
+    # Byte length bounds the token count; only consult the tokenizer when it matters
+    if len(user_content.encode()) <= _input_budget(LOCAL_LAB_BATCH_SYSTEM_PROMPT, max_tokens, None):
+        return True
+    tokenizer = _tokenizer()
+    budget = _input_budget(LOCAL_LAB_BATCH_SYSTEM_PROMPT, max_tokens, tokenizer)
+    return _count_tokens(user_content, tokenizer) <= budget
 
-    payload = {
-        "model": FOUNDRY_LOCAL_MODEL_ID,
-        "messages": [
-            {"role": "system", "content": LOCAL_LAB_SYSTEM_PROMPT},
-            {"role": "user", "content": lab_text},
-        ],
-        "max_tokens": 256,
-        "temperature": 0.2,
-    }
 
-    headers = {
-        "Content-Type": "application/json",
-    }
+async def summarize_lab_texts(lab_texts: List[str]) -> List[Dict[str, Any]]:
+    """
+    Summarize several lab reports with a single Foundry Local inference.
 
-    print(f"[LOCAL TOOL] POST {FOUNDRY_LOCAL_CHAT_URL}")
-    resp = requests.post(
-        FOUNDRY_LOCAL_CHAT_URL,
-        headers=headers,
-        data=json.dumps(payload),
-        timeout=120,
+    Cached reports are served from the cache; the rest are sent together in one
+    prompt, or one by one if the combined prompt would not fit the context window.
+    Returns one summary dict per input, in order.
+    """
+    lab_texts = [_normalize_lab_text(text) for text in lab_texts]
+    keys = [_summary_cache_key(text) for text in lab_texts]
+    results: List[Optional[Dict[str, Any]]] = [_summary_cache_get(key) for key in keys]
+
+    missing = [i for i, result in enumerate(results) if result is None]
+    if not missing:
+        return results
+
+    user_content = "Summarize each lab report.\n\n" + "\n\n".join(
+        f"=== REPORT {n} ===\n{lab_texts[i]}" for n, i in enumerate(missing, start=1)
     )
+    max_tokens = sum(_estimate_max_tokens(lab_texts[i]) for i in missing)
+    if len(missing) == 1 or not _batch_fits(user_content, max_tokens):
+        summaries = await asyncio.gather(*(summarize_lab_text(lab_texts[i]) for i in missing))
+        for i, lab_summary in zip(missing, summaries):
+            results[i] = lab_summary
+    else:
+        body = _request_body(
+            _lab_batch_request_prefix(len(missing)),
+            user_content,
+            max_tokens,
+        )
+        reports = (await _run_lab_model(body, LabSummaryBatch))["reports"]
+        if len(reports) != len(missing):
+            raise ValueError(
+                f"Local model returned {len(reports)} summaries for {len(missing)} reports"
+            )
+        for i, lab_summary in zip(missing, reports):
+            _summary_cache_put(keys[i], lab_summary)
+            results[i] = lab_summary
 
-    resp.raise_for_status()
-    data = resp.json()
+    return results
 
-    # OpenAI-compatible shape: choices[0].message.content
-    content = data["choices"][0]["message"]["content"]
 
-    # Handle string vs list-of-parts
-    if isinstance(content, list):
-        content_text = "".join(
-            part.get("text", "") for part in content if isinstance(part, dict)
-        )
-    else:
-        content_text = content
+@ai_function(
+    name="summarize_lab_reports",
+    description=(
+        "Summarize several raw lab reports at once into structured abnormalities using a "
+        "local model running on the user's GPU. Prefer this over summarize_lab_report "
+        "whenever the user provides more than one lab report."
+    ),
+)
+async def summarize_lab_reports(
+    lab_texts: Annotated[
+        List[str],
+        Field(description="The raw text of each lab report to summarize, one entry per report."),
+    ],
+) -> List[Dict[str, Any]]:
+    """
+    Tool: summarize multiple lab reports in one Foundry Local (Phi-4-mini) call.
+    """
+    return await summarize_lab_texts(lab_texts)
 
-    print("[LOCAL TOOL] Raw content from model:")
-    print(content_text)
 
-    # Strip ```json fences if present, then parse JSON
-    cleaned = _strip_code_fences(content_text)
-    lab_summary = json.loads(cleaned)
-    print("[LOCAL TOOL] Parsed lab summary JSON:")
-    print(json.dumps(lab_summary, indent=2))
+# ========= Background Tool Tasks =========
+
+class TaskManager:
+    """
+    Run tool work in the background and hand out results by task id.
+
+    Each result is handed out once. Results nobody collects are evicted after
+    `result_ttl` seconds so a long-lived process doesn't accumulate them.
+    """
+
+    def __init__(self, result_ttl: float = 600.0) -> None:
+        self.result_ttl = result_ttl
+        self._tasks: Dict[str, "asyncio.Task[Any]"] = {}
+        # task_id -> (finished_at, result) for tasks that are done but not collected
+        self._results: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+
+    def submit(self, coro: Awaitable[Any]) -> str:
+        """
+        Schedule `coro` and return its task id immediately.
+        """
+        self._evict_expired()
+        task_id = uuid.uuid4().hex
+        task = asyncio.ensure_future(coro)
+        self._tasks[task_id] = task
+        task.add_done_callback(lambda t: self._on_done(task_id, t))
+        return task_id
+
+    def _on_done(self, task_id: str, task: "asyncio.Task[Any]") -> None:
+        if task_id not in self._tasks:
+            # Dropped by cancel_all()
+            return
+        if task.cancelled():
+            result = {"task_id": task_id, "status": "CANCELLED"}
+        elif task.exception() is not None:
+            result = {"task_id": task_id, "status": "FAILED", "error": str(task.exception())}
+        else:
+            result = {"task_id": task_id, "status": "COMPLETED", "result": task.result()}
+        self._results[task_id] = (time.monotonic(), result)
+
+    def _evict_expired(self) -> None:
+        cutoff = time.monotonic() - self.result_ttl
+        for task_id in [t for t, (done_at, _) in self._results.items() if done_at < cutoff]:
+            del self._results[task_id]
+            self._tasks.pop(task_id, None)
+
+    async def get(self, task_id: str, wait_seconds: float = 0) -> Dict[str, Any]:
+        """
+        Return the finished result for `task_id`, waiting up to `wait_seconds`.
+
+        Pending tasks report IN_PROGRESS; collected or evicted ones report UNKNOWN.
+        """
+        self._evict_expired()
+        task = self._tasks.get(task_id)
+        if task is None:
+            return {"task_id": task_id, "status": "UNKNOWN"}
+        if not task.done() and wait_seconds > 0:
+            await asyncio.wait({task}, timeout=wait_seconds)
+        if task_id not in self._results:
+            return {"task_id": task_id, "status": "IN_PROGRESS"}
+        del self._tasks[task_id]
+        return self._results.pop(task_id)[1]
+
+    def cancel_all(self) -> None:
+        for task in self._tasks.values():
+            task.cancel()
+        self._tasks.clear()
+        self._results.clear()
 
-    # Return dict – Agent Framework will serialize this as the tool result
-    return lab_summary
+
+_TASKS = TaskManager()
+
+
+@ai_function(
+    name="start_lab_report_summary",
+    description=(
+        "Start summarizing a raw lab report on the user's GPU in the background and "
+        "return a task_id immediately. Retrieve the summary with get_tool_result."
+    ),
+)
+async def start_lab_report_summary(
+    lab_text: Annotated[str, Field(description="The raw text of the lab report to summarize.")],
+) -> Dict[str, Any]:
+    """
+    Tool: submit a lab report summary as a background task.
+    """
+    task_id = _TASKS.submit(summarize_lab_text(lab_text))
+    return {"task_id": task_id, "status": "IN_PROGRESS"}
+
+
+@ai_function(
+    name="get_tool_result",
+    description=(
+        "Get the result of a background tool task by task_id. Returns status IN_PROGRESS "
+        "while it is still running, or COMPLETED with the result."
+    ),
+)
+async def get_tool_result(
+    task_id: Annotated[str, Field(description="The task_id returned when the task was started.")],
+    wait_seconds: Annotated[
+        float,
+        Field(description="How long to wait for completion before returning.", ge=0, le=60),
+    ] = 0,
+) -> Dict[str, Any]:
+    """
+    Tool: poll (or briefly wait on) a background tool task.
+    """
+    return await _TASKS.get(task_id, wait_seconds)
+
+
+# ========= Speculative Local Summary =========
+
+# Lab-like content: common units, or dot-leader rows ending in a number
+_LAB_UNIT_RE = re.compile(r"\b(?:mg/dL|g/dL|mmol/L|mg/L|U/L|x10\^\d+/µL)")
+_LAB_ROW_RE = re.compile(r"\.\.\.+\s*\d")
+
+
+def _looks_like_labs(text: str) -> bool:
+    """
+    Cheap check for raw lab results in free text.
+    """
+    if _LAB_UNIT_RE.search(text):
+        return True
+    return len(_LAB_ROW_RE.findall(text)) >= 2
+
+
+def _start_speculative_summary(text: str) -> Optional["asyncio.Task[Dict[str, Any]]"]:
+    """
+    Start the local summary in the background when `text` looks like a lab report,
+    so it runs while the agent is being fetched or created.
+    """
+    if not _looks_like_labs(text):
+        return None
+    return asyncio.create_task(summarize_lab_text(text))
+
+
+async def _collect_speculative_summary(
+    task: Optional["asyncio.Task[Dict[str, Any]]"],
+) -> Optional[Dict[str, Any]]:
+    """
+    Await a speculative summary; failures fall back to the agent calling the tool.
+    """
+    if task is None:
+        return None
+    try:
+        return await task
+    except Exception:
+        logger.warning("[LOCAL TOOL] Speculative lab summary failed", exc_info=True)
+        return None
+
+
+# ========= Cloud Agent (built once, reused across requests) =========
+
+# The credential caches tokens internally, so keeping it (and the agent client)
+# alive avoids re-running `az account get-access-token` on every request.
+_AGENT_STACK: Optional[AsyncExitStack] = None
+_AGENT: Optional[ChatAgent] = None
+_AGENT_LOCK = asyncio.Lock()
+
+
+async def _get_agent() -> ChatAgent:
+    """
+    Return the process-wide agent, creating the credential and client on first use.
+    """
+    global _AGENT_STACK, _AGENT
+    async with _AGENT_LOCK:
+        if _AGENT is None:
+            stack = AsyncExitStack()
+            try:
+                credential = await stack.enter_async_context(
+                    ChainedTokenCredential(AzureCliCredential(), DefaultAzureCredential())
+                )
+                agent = await stack.enter_async_context(
+                    ChatAgent(
+                        chat_client=AzureAIAgentClient(async_credential=credential),
+                        instructions=SYMPTOM_CHECKER_INSTRUCTIONS,
+                        # 👇 Tool is now attached to the agent
+                        tools=[
+                            summarize_lab_report,
+                            summarize_lab_reports,
+                            start_lab_report_summary,
+                            get_tool_result,
+                        ],
+                        # Let the model emit several tool calls per turn (parallel_tool_calls);
+                        # the tools are coroutines and safe to run concurrently.
+                        allow_multiple_tool_calls=True,
+                        name="hybrid-symptom-checker",
+                    )
+                )
+            except BaseException:
+                await stack.aclose()
+                raise
+            _AGENT_STACK, _AGENT = stack, agent
+        return _AGENT
+
+
+async def shutdown() -> None:
+    """
+    Close the cached agent, pending background tasks and the Foundry Local session.
+    """
+    global _AGENT_STACK, _AGENT
+    async with _AGENT_LOCK:
+        if _AGENT_STACK is not None:
+            await _AGENT_STACK.aclose()
+        _AGENT_STACK, _AGENT = None, None
+    _TASKS.cancel_all()
+    await _close_session()
+
+
+async def handle(user_message: str, lab_text: Optional[str] = None) -> str:
+    """
+    Run one triage request against the cached agent and return its reply text.
+
+    When `lab_text` (or, if it is omitted, `user_message` itself) looks like a lab
+    report, it is summarized locally before the agent turn and the result is
+    attached to the message. The main saving is the skipped tool-call round trip
+    (one cloud completion); local inference only overlaps with cloud work on the
+    first request, while the credential and agent are still being created.
+    """
+    lab_task = _start_speculative_summary(lab_text or user_message)
+
+    try:
+        agent = await _get_agent()
+    except BaseException:
+        # Don't leave local inference running (or its exception unretrieved)
+        if lab_task is not None:
+            lab_task.cancel()
+        raise
+
+    lab_summary = await _collect_speculative_summary(lab_task)
+    if lab_summary is not None:
+        user_message += (
+            "\n\nPre-computed structured labs (from the local summarizer):\n"
+            + orjson.dumps(lab_summary).decode()
+        )
+
+    result = await agent.run(user_message)
+    return result.text
 
 
 # ========= Hybrid Main (Agent uses the local tool) =========
@@ -245,20 +1191,13 @@ async def main():
         "Please provide non-emergency triage guidance."
     )
 
-    async with (
-        AzureCliCredential() as credential,
-        ChatAgent(
-            chat_client=AzureAIAgentClient(async_credential=credential),
-            instructions=SYMPTOM_CHECKER_INSTRUCTIONS,
-            # 👇 Tool is now attached to the agent
-            tools=[summarize_lab_report],
-            name="hybrid-symptom-checker",
-        ) as agent,
-    ):
-        result = await agent.run(user_message)
-
-        print("\n=== Symptom Checker (Hybrid: Local Tool + Cloud Agent) ===\n")
-        print(result.text)
+    try:
+        result_text = await handle(user_message, lab_text=lab_report_text)
+    finally:
+        await shutdown()
+
+    print("\n=== Symptom Checker (Hybrid: Local Tool + Cloud Agent) ===\n")
+    print(result_text)
 
 
 if __name__ == "__main__":